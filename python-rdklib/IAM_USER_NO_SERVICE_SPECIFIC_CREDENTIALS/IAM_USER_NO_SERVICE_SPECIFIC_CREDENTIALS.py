@@ -25,7 +25,20 @@ Reports on:
   AWS::IAM::User
 
 Rule Parameters:
-  None
+  ServiceName
+    (Optional) Only evaluate ServiceSpecificCredentials for this service
+  UserSource
+    (Optional) Where IAM Users are listed from, 'IAM' (default) or 'Config'.
+    'Config' reads the AWS Config inventory (up to 100 users per call) instead of paging iam:ListUsers.
+    The inventory is only as fresh as the configuration recorder: users created since IAM Users were
+    last recorded (e.g. with daily recording, or if recording of AWS::IAM::User has lapsed) are not
+    evaluated. Falls back to IAM when Config returns no users, e.g. in regions not recording global resources
+
+Deployment:
+  With AssumeRoleMode 'false' the iam client retries IAM throttling in botocore's adaptive mode (10 attempts).
+  Assumed-role clients are built by rdklib's ClientFactory, which does not accept a botocore Config, so their
+  retries depend on the operator's configuration: set AWS_RETRY_MODE=adaptive and AWS_MAX_ATTEMPTS=10 in the
+  Lambda function's environment, otherwise botocore's legacy retry mode is used
 
 Scenarios:
   Scenario: 1
@@ -77,28 +90,143 @@ Scenarios:
     Given: An error was encountered listing IAM Users
         Then: log the error
         Then: Raise Exception
+
+  Scenario: 10
+    Given: Listing ServerSpecificCredentials for the IAM User is still throttled after retries
+        Then: log the error
+        Then: Raise Exception
 """
-from rdklib import Evaluator, Evaluation, ConfigRule, ComplianceType
+import collections
+import copy
+import functools
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+import botocore
+from botocore.config import Config
+from rdklib import Evaluator, Evaluation, ConfigRule, ComplianceType, InvalidParametersError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
 RESOURCE_TYPE = "AWS::IAM::User"
 
+COMPLIANT_ANNOTATION = 'No active ServiceSpecific credentials found'
+ERROR_MESSAGE = 'Encountered error checking credentials'
+ERROR_ANNOTATION = f'{ERROR_MESSAGE}. Check custom rule lambda logs'
+
+# Most users are COMPLIANT and their evaluations only differ by resource id, so they are
+# copied from this template rather than re-running Evaluation's validation for every user
+COMPLIANT_EVALUATION = Evaluation(ComplianceType.COMPLIANT, resourceType=RESOURCE_TYPE, annotation=COMPLIANT_ANNOTATION)
+
+USER_SOURCES = ('IAM', 'Config')
+
+# Deleted users stay in the Config inventory; the query excludes them so they aren't reported
+# NON_COMPLIANT when list_service_specific_credentials fails with NoSuchEntity
+USER_INVENTORY_QUERY = (
+    "SELECT resourceId, resourceName "
+    f"WHERE resourceType = '{RESOURCE_TYPE}' "
+    "AND configurationItemStatus IN ('OK', 'ResourceDiscovered', 'ResourceNotRecorded')"
+)
+
+# Users are checked concurrently by threads sharing one iam client. ClientFactory.build_client does not
+# accept a botocore Config, so the client keeps botocore's default max_pool_connections of 10; more workers
+# than that would open connections the pool then discards
+MAX_WORKERS = 10
+
+# Applied to the iam client built without assume-role; ClientFactory can't take a Config for assumed-role clients
+IAM_CLIENT_CONFIG = Config(retries={'mode': 'adaptive', 'max_attempts': 10}, max_pool_connections=MAX_WORKERS)
+
+# Throttling that outlasts the retries fails the evaluation instead of reporting users NON_COMPLIANT
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException')
+
+# list_service_specific_credentials responses are cached for the life of a warm Lambda container.
+# Entries are keyed on UserId (unique across accounts) and expire rather than being evicted by size,
+# as IAM is eventually consistent. Expired entries are pruned at the start of each evaluation
+CREDENTIALS_CACHE_TTL_SECONDS = 60
+_CRED_CACHE = {}
+_CRED_CACHE_LOCK = threading.Lock()
+
+# iam client reused across warm invocations when the rule runs with the Lambda's own role.
+# Assumed-role clients carry short-lived STS credentials for one account, so they are built per invocation
+_IAM_CLIENT = None
+
 class IAM_USER_NO_SERVICE_SPECIFIC_CREDENTIALS(ConfigRule):
-    def get_credentials_for_user(self, iam_client, user_name, service_name, marker):
-        # list_service_specific_credentials throws an error if you supply None to 'ServiceName' or 'Marker'
-        if service_name == None:
-            if marker == None:
-                return iam_client.list_service_specific_credentials(UserName=user_name)
-            return iam_client.list_service_specific_credentials(UserName=user_name, Marker=marker)
-        if marker == None:
-            return iam_client.list_service_specific_credentials(UserName=user_name, ServiceName=service_name)
-        return iam_client.list_service_specific_credentials(UserName=user_name, ServiceName=service_name, Marker=marker)
-
-
-    def evaluate_user(self, iam_client, user_name, user_id, service_name):
+    def bind_list_credentials(self, iam_client, service_name):
+        # ServiceName is fixed for the whole evaluation, so it is bound once instead of on every request.
+        # list_service_specific_credentials throws an error if you supply None to 'ServiceName'
+        if service_name:
+            return functools.partial(iam_client.list_service_specific_credentials, ServiceName=service_name)
+        return iam_client.list_service_specific_credentials
+
+
+    def get_credentials_for_user(self, list_credentials, user_name, marker):
+        # list_service_specific_credentials throws an error if you supply None to 'Marker'
+        kwargs = {'UserName': user_name}
+        if marker is not None:
+            kwargs['Marker'] = marker
+        return list_credentials(**kwargs)
+
+
+    def prune_credentials_cache(self):
+        now = time.monotonic()
+        with _CRED_CACHE_LOCK:
+            expired = [key for key, (cached_at, _) in _CRED_CACHE.items() if now - cached_at >= CREDENTIALS_CACHE_TTL_SECONDS]
+            for key in expired:
+                del _CRED_CACHE[key]
+
+
+    def get_cached_credentials_for_user(self, list_credentials, user_name, user_id, service_name, marker):
+        # Not double-checked: each user is evaluated by a single worker, so two threads never miss on the same key
+        key = (user_id, service_name, marker)
+        now = time.monotonic()
+        with _CRED_CACHE_LOCK:
+            cached = _CRED_CACHE.get(key)
+        if cached is not None and now - cached[0] < CREDENTIALS_CACHE_TTL_SECONDS:
+            return cached[1]
+
+        credentials = self.get_credentials_for_user(list_credentials, user_name, marker)
+        with _CRED_CACHE_LOCK:
+            _CRED_CACHE[key] = (now, credentials)
+        return credentials
+
+
+    def get_users_from_config(self, config_client):
+        paginator = config_client.get_paginator('select_resource_config')
+        for page in paginator.paginate(Expression=USER_INVENTORY_QUERY):
+            for result in page['Results']:
+                resource = json.loads(result)
+                yield {'UserName': resource['resourceName'], 'UserId': resource['resourceId']}
+
+
+    def get_users(self, client_factory, iam_client, user_source):
+        # The AWS Config inventory returns up to 100 users per call. IAM Users are only recorded in the
+        # region recording global resources, so fall back to list_users when Config returns none
+        found = False
+        if user_source == 'Config':
+            try:
+                for user in self.get_users_from_config(client_factory.build_client('config')):
+                    found = True
+                    yield user
+            except botocore.exceptions.ClientError as e:
+                if found:
+                    raise e
+                logger.warning('Failure querying AWS Config for IAM users, falling back to IAM: %s', e)
+        if not found:
+            paginator = iam_client.get_paginator('list_users')
+            for page in paginator.paginate():
+                yield from page['Users']
+
+
+    def evaluate_user(self, list_credentials, user_name, user_id, service_name):
         marker = None
         while True:
-            credentials = self.get_credentials_for_user(iam_client, user_name, service_name, marker)
-            for cred in credentials['ServiceSpecificCredentials']:
+            credentials = self.get_cached_credentials_for_user(list_credentials, user_name, user_id, service_name, marker)
+            creds_list = credentials['ServiceSpecificCredentials']
+            for cred in creds_list:
                 if (cred['Status'] == 'Active'):
                     # found active credential, return NON_COMPLIANT
                     return Evaluation(
@@ -108,52 +236,91 @@ class IAM_USER_NO_SERVICE_SPECIFIC_CREDENTIALS(ConfigRule):
                         annotation=f'Active service specific credential found: {cred["ServiceSpecificCredentialId"]}'
                     )
             # IsTruncated is not present in repsonse if not paginated
-            if 'IsTruncated' in credentials and credentials['IsTruncated']:
+            if credentials.get('IsTruncated'):
                 # Truncated response, use 'marker' in next request for next page
                 marker = credentials['Marker']
             else:
                 break
 
-        return Evaluation(
-            ComplianceType.COMPLIANT, 
-            resourceId=user_id,
-            resourceType=RESOURCE_TYPE,
-            annotation='No active ServiceSpecific credentials found'
-        )
+        evaluation = copy.copy(COMPLIANT_EVALUATION)
+        evaluation.complianceResourceId = user_id
+        return evaluation
 
 
     def handle_credential_check_error(self, e, user_id):
-        msg = 'Encountered error checking credentials'
-        print(f'[ERROR] {msg}: {str(e)}')
+        logger.error('%s: %s', ERROR_MESSAGE, e, exc_info=e)
         # intentional over-reporting with annotation to ensure all IAM Users are evaluated
         return Evaluation(
             ComplianceType.NON_COMPLIANT,
             resourceId=user_id,
             resourceType=RESOURCE_TYPE,
-            annotation=f'{msg}. Check custom rule lambda logs'
+            annotation=ERROR_ANNOTATION
         )
 
 
+    def evaluate_parameters(self, rule_parameters):
+        valid_rule_parameters = rule_parameters
+        if 'UserSource' not in rule_parameters:
+            valid_rule_parameters['UserSource'] = 'IAM'
+        if valid_rule_parameters['UserSource'] not in USER_SOURCES:
+            raise InvalidParametersError(f'UserSource must be one of: {", ".join(USER_SOURCES)}')
+        return valid_rule_parameters
+
+
+    def get_iam_client(self, event, client_factory):
+        global _IAM_CLIENT
+        if self.get_assume_role_mode(event):
+            return client_factory.build_client('iam')
+        if _IAM_CLIENT is None:
+            # built directly rather than through ClientFactory.build_client so the retry Config can be applied
+            _IAM_CLIENT = boto3.client('iam', region_name=self.get_assume_role_region(event), config=IAM_CLIENT_CONFIG)
+        return _IAM_CLIENT
+
+
     def evaluate_periodic(self, event, client_factory, valid_rule_parameters):
         evaluations = []
         service_name = valid_rule_parameters['ServiceName'] if 'ServiceName' in valid_rule_parameters else None
-        iam_client = client_factory.build_client('iam')
+        user_source = valid_rule_parameters.get('UserSource', 'IAM')
+        iam_client = self.get_iam_client(event, client_factory)
+        list_credentials = self.bind_list_credentials(iam_client, service_name)
+        self.prune_credentials_cache()
 
-        try:
-            paginator = iam_client.get_paginator('list_users')
-            for page in paginator.paginate():
-                for user in page['Users']:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # the iam client is thread-safe, so a single client is shared by all workers.
+            # Users are submitted as each page arrives, so fetching the next page
+            # overlaps with the credential checks already in flight
+            futures = collections.deque()
+            seen_user_ids = set()
+            try:
+                for user in self.get_users(client_factory, iam_client, user_source):
                     user_id = user['UserId']
-                    user_name = user['UserName']
-                    try:
-                        evaluations.append(self.evaluate_user(iam_client, user_name, user_id, service_name))
-                    except Exception as e:
-                        evaluations.append(self.handle_credential_check_error(e, user_id))
-            return evaluations
-        except Exception as e:
-            print(f'[ERROR] Failure listing IAM users: {str(e)}')
-            raise e
+                    # pages can repeat a user while IAM is being modified, only check each user once
+                    if user_id in seen_user_ids:
+                        continue
+                    seen_user_ids.add(user_id)
+                    futures.append((user_id, executor.submit(self.evaluate_user, list_credentials, user['UserName'], user_id, service_name)))
+            except Exception as e:
+                logger.error('Failure listing IAM users: %s', e, exc_info=e)
+                # listing users failed part way, don't run the credential checks still queued
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise e
 
+            # results are collected in submission order so evaluations follow the order users were listed.
+            # rdklib only accepts a list of evaluations, so futures are released as they are consumed instead
+            while futures:
+                user_id, future = futures.popleft()
+                try:
+                    evaluations.append(future.result())
+                except botocore.exceptions.ClientError as e:
+                    if e.response['Error']['Code'] in THROTTLING_ERROR_CODES:
+                        logger.error('Throttled listing service specific credentials for IAM user %s after retries: %s', user_id, e)
+                        # IAM is still rate limiting, stop rather than run the remaining checks into it
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        raise e
+                    evaluations.append(self.handle_credential_check_error(e, user_id))
+                except Exception as e:
+                    evaluations.append(self.handle_credential_check_error(e, user_id))
+        return evaluations
 
 def lambda_handler(event, context):
     my_rule = IAM_USER_NO_SERVICE_SPECIFIC_CREDENTIALS()
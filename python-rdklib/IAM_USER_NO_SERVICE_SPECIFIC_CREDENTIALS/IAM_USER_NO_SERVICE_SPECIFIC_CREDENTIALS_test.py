@@ -9,6 +9,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for
 # the specific language governing permissions and limitations under the License.
 import botocore
+import time
 import unittest
 from unittest.mock import MagicMock, patch
 
@@ -25,6 +26,8 @@ RESOURCE_TYPE = "AWS::IAM::User"
 CLIENT_FACTORY = MagicMock()
 IAM_CLIENT_MOCK = MagicMock()
 IAM_USER_PAGINATOR_MOCK = MagicMock()
+CONFIG_CLIENT_MOCK = MagicMock()
+CONFIG_PAGINATOR_MOCK = MagicMock()
 
 MODULE = __import__("IAM_USER_NO_SERVICE_SPECIFIC_CREDENTIALS")
 RULE = MODULE.IAM_USER_NO_SERVICE_SPECIFIC_CREDENTIALS()
@@ -32,6 +35,8 @@ RULE = MODULE.IAM_USER_NO_SERVICE_SPECIFIC_CREDENTIALS()
 def mock_get_client(client_name, *args, **kwargs):
     if client_name == "iam":
         return IAM_CLIENT_MOCK
+    if client_name == "config":
+        return CONFIG_CLIENT_MOCK
     raise Exception("Attempting to create an unknown client")
 
 
@@ -48,6 +53,7 @@ class ComplianceTest(unittest.TestCase):
     NON_MATCHING_SERVICE_NAME = 'nonMatchingService'
     NON_MATCHING_CREDENTIAL_ID = 'nonMatchingCredential'
     PARAMETERS = { 'ServiceName': MATCHING_SERVICE_NAME }
+    CONFIG_SOURCE_PARAMETERS = { 'UserSource': 'Config' }
 
     CLIENT_ERROR = botocore.exceptions.ClientError({
         'Error': {
@@ -57,6 +63,14 @@ class ComplianceTest(unittest.TestCase):
         }, 
         'operation'
     )
+    THROTTLING_ERROR = botocore.exceptions.ClientError({
+        'Error': {
+            'Code': 'Throttling',
+            'Message': 'Rate exceeded'
+            }
+        },
+        'ListServiceSpecificCredentials'
+    )
 
     ### IAM.list_users mock response
     user_page_empty = [ {  "Users": [ ] } ]
@@ -64,6 +78,11 @@ class ComplianceTest(unittest.TestCase):
     user_page_expect_non_compliant = [ {  "Users": [ { "UserName": "NAME",  "UserId": NON_COMPLIANT_USER_ID } ] } ]
 
 
+    ### Config.select_resource_config mock responses
+    config_page_empty = [ { "Results": [ ] } ]
+    config_page_expect_compliant = [ { "Results": [ '{"resourceId": "%s", "resourceName": "NAME"}' % COMPLIANT_USER_ID ] } ]
+
+
     ### IAM.list_service_specific_credentials mock responses
     no_service_specific_credentials = { 'ServiceSpecificCredentials': [], 'IsTruncated': False }
     service_specific_credentials_active = { 
@@ -76,6 +95,7 @@ class ComplianceTest(unittest.TestCase):
         ],
         'IsTruncated': False
     }
+    no_service_specific_credentials_page_one = { 'ServiceSpecificCredentials': [], 'IsTruncated': True, 'Marker': 'getPageTwo' }
     service_specific_credentials_active_page_one = { 
         'ServiceSpecificCredentials': [
             {
@@ -123,6 +143,11 @@ class ComplianceTest(unittest.TestCase):
     def setUp(self):
         IAM_CLIENT_MOCK.reset_mock(return_value=True, side_effect=True)
         IAM_CLIENT_MOCK.get_paginator.return_value = IAM_USER_PAGINATOR_MOCK
+        MODULE._CRED_CACHE.clear()
+        MODULE._IAM_CLIENT = None
+        CONFIG_CLIENT_MOCK.reset_mock(return_value=True, side_effect=True)
+        CONFIG_CLIENT_MOCK.get_paginator.return_value = CONFIG_PAGINATOR_MOCK
+        CONFIG_PAGINATOR_MOCK.paginate = MagicMock(return_value=self.config_page_empty)
 
 
     # Scenario 1 - Returns Empty if no IAM Users
@@ -263,6 +288,191 @@ class ComplianceTest(unittest.TestCase):
                 annotation=f'Active service specific credential found: {self.MATCHING_CREDENTIAL_ID}'
             )]
         assert_successful_evaluation(self, response, response_expected)
+        IAM_CLIENT_MOCK.list_service_specific_credentials.assert_called_once_with(UserName='NAME', ServiceName=self.MATCHING_SERVICE_NAME)
+
+
+    # Scenario 7: parameter matches - a truncated empty filtered page still follows the marker
+    def test_scenario7_sscredentials_empty_filtered_page_paginates_returns_non_compliant(self):
+        IAM_CLIENT_MOCK.list_service_specific_credentials.side_effect = [
+            self.no_service_specific_credentials_page_one,
+            self.service_specific_credentials_active_page_two
+        ]
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = self.user_page_expect_non_compliant
+
+        response = RULE.evaluate_periodic({}, CLIENT_FACTORY, self.PARAMETERS)
+        response_expected = [
+            Evaluation(
+                ComplianceType.NON_COMPLIANT,
+                resourceId=self.NON_COMPLIANT_USER_ID,
+                resourceType=RESOURCE_TYPE,
+                annotation=f'Active service specific credential found: {self.MATCHING_CREDENTIAL_ID}'
+            )]
+        assert_successful_evaluation(self, response, response_expected)
+        assert IAM_CLIENT_MOCK.list_service_specific_credentials.call_count == 2
+
+
+    # Scenario 2 & 6: Multiple users across pages - evaluations keep list_users order
+    def test_multiple_users_evaluated_in_list_users_order(self):
+        def mock_list_credentials(UserName, **kwargs):
+            if UserName == 'NON_COMPLIANT_NAME':
+                return self.service_specific_credentials_active
+            return self.no_service_specific_credentials
+        IAM_CLIENT_MOCK.list_service_specific_credentials.side_effect = mock_list_credentials
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = [
+            { "Users": [ { "UserName": "NON_COMPLIANT_NAME", "UserId": self.NON_COMPLIANT_USER_ID } ] },
+            { "Users": [ { "UserName": "NAME", "UserId": self.COMPLIANT_USER_ID } ] }
+        ]
+
+        response = RULE.evaluate_periodic({}, CLIENT_FACTORY, {})
+        response_expected = [
+            Evaluation(
+                ComplianceType.NON_COMPLIANT,
+                resourceId=self.NON_COMPLIANT_USER_ID,
+                resourceType=RESOURCE_TYPE,
+                annotation=f'Active service specific credential found: {self.MATCHING_CREDENTIAL_ID}'
+            ),
+            Evaluation(
+                ComplianceType.COMPLIANT,
+                resourceId=self.COMPLIANT_USER_ID,
+                resourceType=RESOURCE_TYPE,
+                annotation='No active ServiceSpecific credentials found'
+            )]
+        assert_successful_evaluation(self, response, response_expected, 2)
+
+
+    # No scenario - a user repeated across list_users pages is only evaluated once
+    def test_duplicate_user_across_pages_evaluated_once(self):
+        IAM_CLIENT_MOCK.list_service_specific_credentials.return_value = self.no_service_specific_credentials
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = self.user_page_expect_compliant * 2
+
+        response = RULE.evaluate_periodic({}, CLIENT_FACTORY, {})
+        response_expected = [
+            Evaluation(
+                ComplianceType.COMPLIANT,
+                resourceId=self.COMPLIANT_USER_ID,
+                resourceType=RESOURCE_TYPE,
+                annotation='No active ServiceSpecific credentials found'
+            )]
+        assert_successful_evaluation(self, response, response_expected)
+        assert IAM_CLIENT_MOCK.list_service_specific_credentials.call_count == 1
+
+
+    # No scenario - IAM Users are read from the AWS Config inventory when UserSource is Config
+    def test_users_from_config_inventory_skips_list_users(self):
+        CONFIG_PAGINATOR_MOCK.paginate.return_value = self.config_page_expect_compliant
+        IAM_CLIENT_MOCK.list_service_specific_credentials.return_value = self.no_service_specific_credentials
+
+        response = RULE.evaluate_periodic({}, CLIENT_FACTORY, self.CONFIG_SOURCE_PARAMETERS)
+        response_expected = [
+            Evaluation(
+                ComplianceType.COMPLIANT,
+                resourceId=self.COMPLIANT_USER_ID,
+                resourceType=RESOURCE_TYPE,
+                annotation='No active ServiceSpecific credentials found'
+            )]
+        assert_successful_evaluation(self, response, response_expected)
+        IAM_CLIENT_MOCK.list_service_specific_credentials.assert_called_once_with(UserName='NAME')
+        IAM_CLIENT_MOCK.get_paginator.assert_not_called()
+
+
+    # No scenario - the AWS Config inventory query only returns users that have not been deleted
+    def test_config_inventory_query_excludes_deleted_users(self):
+        CONFIG_PAGINATOR_MOCK.paginate.return_value = self.config_page_expect_compliant
+        IAM_CLIENT_MOCK.list_service_specific_credentials.return_value = self.no_service_specific_credentials
+
+        RULE.evaluate_periodic({}, CLIENT_FACTORY, self.CONFIG_SOURCE_PARAMETERS)
+        expression = CONFIG_PAGINATOR_MOCK.paginate.call_args.kwargs['Expression']
+        self.assertIn("configurationItemStatus IN ('OK', 'ResourceDiscovered', 'ResourceNotRecorded')", expression)
+
+
+    # No scenario - IAM Users are listed from IAM by default
+    def test_default_user_source_does_not_query_config(self):
+        IAM_CLIENT_MOCK.list_service_specific_credentials.return_value = self.no_service_specific_credentials
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = self.user_page_expect_compliant
+
+        RULE.evaluate_periodic({}, CLIENT_FACTORY, RULE.evaluate_parameters({}))
+        CONFIG_PAGINATOR_MOCK.paginate.assert_not_called()
+
+
+    # No scenario - an unsupported UserSource is rejected
+    def test_invalid_user_source_raises_invalid_parameters(self):
+        with self.assertRaises(MODULE.InvalidParametersError):
+            RULE.evaluate_parameters({ 'UserSource': 'S3' })
+
+
+    # No scenario - falls back to IAM when the AWS Config inventory has no users
+    def test_config_inventory_empty_falls_back_to_list_users(self):
+        CONFIG_PAGINATOR_MOCK.paginate.return_value = self.config_page_empty
+        IAM_CLIENT_MOCK.list_service_specific_credentials.return_value = self.no_service_specific_credentials
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = self.user_page_expect_compliant
+
+        response = RULE.evaluate_periodic({}, CLIENT_FACTORY, self.CONFIG_SOURCE_PARAMETERS)
+        response_expected = [
+            Evaluation(
+                ComplianceType.COMPLIANT,
+                resourceId=self.COMPLIANT_USER_ID,
+                resourceType=RESOURCE_TYPE,
+                annotation='No active ServiceSpecific credentials found'
+            )]
+        assert_successful_evaluation(self, response, response_expected)
+        CONFIG_PAGINATOR_MOCK.paginate.assert_called_once()
+        IAM_CLIENT_MOCK.get_paginator.assert_called_once_with('list_users')
+
+
+    # No scenario - falls back to IAM when the AWS Config query fails
+    def test_config_query_error_falls_back_to_list_users(self):
+        CONFIG_PAGINATOR_MOCK.paginate.side_effect = self.CLIENT_ERROR
+        IAM_CLIENT_MOCK.list_service_specific_credentials.return_value = self.no_service_specific_credentials
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = self.user_page_expect_compliant
+
+        response = RULE.evaluate_periodic({}, CLIENT_FACTORY, self.CONFIG_SOURCE_PARAMETERS)
+        response_expected = [
+            Evaluation(
+                ComplianceType.COMPLIANT,
+                resourceId=self.COMPLIANT_USER_ID,
+                resourceType=RESOURCE_TYPE,
+                annotation='No active ServiceSpecific credentials found'
+            )]
+        assert_successful_evaluation(self, response, response_expected)
+
+
+    # No scenario - the iam client is reused across invocations when not assuming a role
+    def test_iam_client_reused_without_assume_role(self):
+        event = { 'ruleParameters': '{"AssumeRoleMode": "false"}' }
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = self.user_page_empty
+
+        with patch.object(MODULE.boto3, "client", MagicMock(return_value=IAM_CLIENT_MOCK)) as mock_boto3_client:
+            RULE.evaluate_periodic(event, CLIENT_FACTORY, {})
+            RULE.evaluate_periodic(event, CLIENT_FACTORY, {})
+        mock_boto3_client.assert_called_once_with('iam', region_name=None, config=MODULE.IAM_CLIENT_CONFIG)
+
+
+    # No scenario - repeated evaluation within the cache TTL reuses the credentials response
+    def test_repeated_evaluation_uses_cached_credentials(self):
+        IAM_CLIENT_MOCK.list_service_specific_credentials.return_value = self.no_service_specific_credentials
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = self.user_page_expect_compliant
+
+        RULE.evaluate_periodic({}, CLIENT_FACTORY, {})
+        response = RULE.evaluate_periodic({}, CLIENT_FACTORY, {})
+        response_expected = [
+            Evaluation(
+                ComplianceType.COMPLIANT,
+                resourceId=self.COMPLIANT_USER_ID,
+                resourceType=RESOURCE_TYPE,
+                annotation='No active ServiceSpecific credentials found'
+            )]
+        assert_successful_evaluation(self, response, response_expected)
+        assert IAM_CLIENT_MOCK.list_service_specific_credentials.call_count == 1
+
+
+    # No scenario - expired credentials cache entries are pruned on evaluation
+    def test_expired_cache_entries_pruned(self):
+        expired_at = MODULE.time.monotonic() - MODULE.CREDENTIALS_CACHE_TTL_SECONDS
+        MODULE._CRED_CACHE[('deleted_user_id', None, None)] = (expired_at, self.no_service_specific_credentials)
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = self.user_page_empty
+
+        RULE.evaluate_periodic({}, CLIENT_FACTORY, {})
+        self.assertEqual(MODULE._CRED_CACHE, {})
 
 
     # Scenario 8: Error calling list_service_specific_credentials
@@ -291,6 +501,50 @@ class ComplianceTest(unittest.TestCase):
             self.assertEqual(e, self.CLIENT_ERROR)
     
 
+    # Scenario 9: Error listing IAM users part way - queued credential checks are cancelled
+    def test_scenario9_listUsers_error_after_first_page_cancels_queued_checks(self):
+        user_count = 50
+        def mock_paginate():
+            yield { "Users": [ { "UserName": f"NAME{i}", "UserId": f"user_id_{i}" } for i in range(user_count) ] }
+            raise self.CLIENT_ERROR
+        def mock_list_credentials(**kwargs):
+            time.sleep(0.1)
+            return self.no_service_specific_credentials
+        IAM_CLIENT_MOCK.get_paginator.return_value = MagicMock(paginate=MagicMock(side_effect=mock_paginate))
+        IAM_CLIENT_MOCK.list_service_specific_credentials.side_effect = mock_list_credentials
+
+        with self.assertRaises(botocore.exceptions.ClientError) as context:
+            RULE.evaluate_periodic({}, CLIENT_FACTORY, {})
+        self.assertEqual(context.exception, self.CLIENT_ERROR)
+        self.assertLess(IAM_CLIENT_MOCK.list_service_specific_credentials.call_count, user_count)
+
+
+    # Scenario 10: Throttled calling list_service_specific_credentials
+    def test_scenario10_listSSCreds_throttled_raises_ex(self):
+        IAM_CLIENT_MOCK.list_service_specific_credentials = MagicMock(side_effect=self.THROTTLING_ERROR)
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = self.user_page_expect_compliant
+        with self.assertRaises(botocore.exceptions.ClientError) as context:
+            RULE.evaluate_periodic({}, CLIENT_FACTORY, {})
+        self.assertEqual(context.exception, self.THROTTLING_ERROR)
+
+
+    # Scenario 10: Throttled for every user - remaining queued credential checks are cancelled
+    def test_scenario10_listSSCreds_throttled_cancels_queued_checks(self):
+        user_count = 50
+        def mock_list_credentials(**kwargs):
+            time.sleep(0.02)
+            raise self.THROTTLING_ERROR
+        IAM_CLIENT_MOCK.list_service_specific_credentials.side_effect = mock_list_credentials
+        IAM_USER_PAGINATOR_MOCK.paginate.return_value = [
+            { "Users": [ { "UserName": f"NAME{i}", "UserId": f"user_id_{i}" } for i in range(user_count) ] }
+        ]
+
+        with self.assertRaises(botocore.exceptions.ClientError) as context:
+            RULE.evaluate_periodic({}, CLIENT_FACTORY, {})
+        self.assertEqual(context.exception, self.THROTTLING_ERROR)
+        self.assertLess(IAM_CLIENT_MOCK.list_service_specific_credentials.call_count, user_count)
+
+
     # No scenario lambda handler passed an event and context
     @patch.object(MODULE.Evaluator, "handle", side_effect=mock_evaluator_handle)
     def test_lambda_handler_called_with_event_and_context(self, mock_evaluator):